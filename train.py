@@ -7,6 +7,11 @@ import time
 import copy
 import warnings
 import errno
+import socket
+import concurrent.futures
+# must be set before the CUDA caching allocator is initialized: the transient
+# Hessian-vector products in save_stats otherwise fragment the memory pool
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128")
 import torch
 import torch.nn as nn
 import torch.nn.parallel
@@ -16,10 +21,12 @@ import torch.optim
 import torch.multiprocessing as mp
 import torch.utils.data
 import torch.utils.data.distributed
+import torch.utils.checkpoint
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
 from models import *
+from models.densenet import _DenseLayer
 from utils import *
 import warnings
 warnings.filterwarnings("ignore")
@@ -34,9 +41,9 @@ model_names = [
     'resnet152'
 ]
 
-model_names = sorted(name for name in models.__dict__
-    if name.islower() and not name.startswith("__")
-    and callable(models.__dict__[name]))
+# architectures provided by the local `models` package, keyed by --arch name
+_ARCH_REGISTRY = {name: globals()[name] for name in model_names}
+model_names = sorted(_ARCH_REGISTRY)
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 parser.add_argument('data', metavar='DIR',
@@ -110,11 +117,82 @@ parser.add_argument('--pretrain_path', type=str,  default='',
 parser.add_argument('-noise_size', type=int, default=10)
 parser.add_argument('--epoch_interval', '-ei', default=1, type=int, metavar='N',
                     help='manual epoch number (useful on restarts)')
+parser.add_argument('--dali', action='store_true',
+                    help='decode and augment training images on the GPU with NVIDIA DALI')
+parser.add_argument('--grad-checkpoint', action='store_true',
+                    help='recompute vgg/densenet feature activations during backward to save '
+                         'memory, typically combined with a doubled --batch-size')
+parser.add_argument('--compile', action='store_true',
+                    help='compile the training model with torch.compile (max-autotune)')
 
 
 
 best_acc1 = 0
 
+# cached-but-unused memory above which save_stats hands blocks back to the driver
+EMPTY_CACHE_THRESHOLD = 1 << 30
+
+
+def build_model(args):
+    if args.arch not in _ARCH_REGISTRY:
+        raise KeyError("unknown architecture '{}'".format(args.arch))
+    return _ARCH_REGISTRY[args.arch](pretrained=args.pretrained)
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def is_log_process(args):
+    """Only the first process of each node writes the csv logs and computes the stats"""
+    return not args.multiprocessing_distributed or args.rank % args.ngpus_per_node == 0
+
+
+def _checkpointed(forward):
+    def run(*inputs):
+        if torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(forward, *inputs, use_reentrant=False)
+        return forward(*inputs)
+    return run
+
+
+def enable_grad_checkpoint(model, arch, segments=4):
+    """Recomputes the activations of model.features in the backward pass instead of storing them"""
+    if arch.startswith('densenet'):
+        for module in model.features.modules():
+            if isinstance(module, _DenseLayer):
+                module.forward = _checkpointed(module.forward)
+    elif arch.startswith('vgg'):
+        features = model.features
+        layers = list(features.children())
+        # split in front of convolutions so no segment starts with an in-place ReLU
+        convs = [i for i, m in enumerate(layers) if isinstance(m, nn.Conv2d)]
+        starts = convs[::max(len(convs) // segments, 1)][:segments]
+        starts[0] = 0
+        # not registered as submodules, so the state_dict keys are unchanged
+        blocks = [_checkpointed(nn.Sequential(*layers[a:b]))
+                  for a, b in zip(starts, starts[1:] + [len(layers)])]
+
+        def forward(x):
+            for block in blocks:
+                x = block(x)
+            return x
+        features.forward = forward
+    else:
+        print('Gradient checkpointing is only implemented for vgg and densenet, '
+              'ignoring --grad-checkpoint for {}.'.format(arch))
+
+
+def unwrap_model(model):
+    # torch.compile keeps the wrapped module in _orig_mod
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.module
+    return model
+
+
 def load_model(path, model, optimizer):
     print("=> loading checkpoint '{}'".format(path))
     checkpoint = torch.load(path)
@@ -151,8 +229,19 @@ def main():
     args.distributed = args.world_size > 1 or args.multiprocessing_distributed
 
     ngpus_per_node = torch.cuda.device_count()
-    
-    
+    # train() and validate() need it to find the first process of each node
+    args.ngpus_per_node = ngpus_per_node
+
+    if not args.distributed and args.gpu is None and ngpus_per_node > 1:
+        # Single node with several GPUs: run one DistributedDataParallel
+        # process per GPU instead of falling back to DataParallel
+        args.multiprocessing_distributed = True
+        args.distributed = True
+        args.world_size = 1
+        args.rank = 0
+        if args.dist_url == parser.get_default('dist_url'):
+            # a free local port, so several jobs can share a node
+            args.dist_url = 'tcp://127.0.0.1:{}'.format(find_free_port())
 
     if args.multiprocessing_distributed:
         # Since we have ngpus_per_node processes per node, the total world_size
@@ -201,64 +290,21 @@ def main_worker(gpu, ngpus_per_node, args):
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
     # create model
-#     if args.pretrained:
-#         print("=> using pre-trained model '{}'".format(args.arch))
-#         model = models.__dict__[args.arch](pretrained=True)
-#     else:
-#         print("=> creating model '{}'".format(args.arch))
-#         model = models.__dict__[args.arch]()
-
     if args.pretrained:
         print("=> using pre-trained model '{}'".format(args.arch))
     else:
         print("=> creating model '{}'".format(args.arch))
 
-    if args.arch == 'alexnet':
-        model = alexnet(pretrained=args.pretrained)
-    elif args.arch == 'squeezenet1_0':
-        model = squeezenet1_0(pretrained=args.pretrained)
-    elif args.arch == 'squeezenet1_1':
-        model = squeezenet1_1(pretrained=args.pretrained)
-    elif args.arch == 'densenet121':
-        model = densenet121(pretrained=args.pretrained)
-    elif args.arch == 'densenet169':
-        model = densenet169(pretrained=args.pretrained)
-    elif args.arch == 'densenet201':
-        model = densenet201(pretrained=args.pretrained)
-    elif args.arch == 'densenet161':
-        model = densenet161(pretrained=args.pretrained)
-    elif args.arch == 'vgg11':
-        model = vgg11(pretrained=args.pretrained)
-    elif args.arch == 'vgg13':
-        model = vgg13(pretrained=args.pretrained)
-    elif args.arch == 'vgg16':
-        model = vgg16(pretrained=args.pretrained)
-    elif args.arch == 'vgg19':
-        model = vgg19(pretrained=args.pretrained)
-    elif args.arch == 'vgg11_bn':
-        model = vgg11_bn(pretrained=args.pretrained)
-    elif args.arch == 'vgg13_bn':
-        model = vgg13_bn(pretrained=args.pretrained)
-    elif args.arch == 'vgg16_bn':
-        model = vgg16_bn(pretrained=args.pretrained)
-    elif args.arch == 'vgg19_bn':
-        model = vgg19_bn(pretrained=args.pretrained)
-    elif args.arch == 'resnet18':
-        model = resnet18(pretrained=args.pretrained)
-    elif args.arch == 'resnet34':
-        model = resnet34(pretrained=args.pretrained)
-    elif args.arch == 'resnet50':
-        model = resnet50(pretrained=args.pretrained)
-    elif args.arch == 'resnet101':
-        model = resnet101(pretrained=args.pretrained)
-    elif args.arch == 'resnet152':
-        model = resnet152(pretrained=args.pretrained)
-    else:
-        raise NotImplementedError
-        
-        
-      
-        
+    model = build_model(args)
+    # NHWC lets cuDNN pick its Tensor Core convolution kernels
+    model = model.to(memory_format=torch.channels_last)
+    if args.grad_checkpoint:
+        enable_grad_checkpoint(model, args.arch)
+
+    # the noise statistics are measured at the full per-node batch size, also
+    # when DistributedDataParallel splits the training batch across GPUs below
+    args.stats_batch_size = args.batch_size
+
     if not torch.cuda.is_available():
         print('using CPU, this will be slow')
     elif args.distributed:
@@ -273,41 +319,61 @@ def main_worker(gpu, ngpus_per_node, args):
             # ourselves based on the total number of GPUs we have
             args.batch_size = int(args.batch_size / ngpus_per_node)
             args.workers = int((args.workers + ngpus_per_node - 1) / ngpus_per_node)
-            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=[args.gpu], bucket_cap_mb=25,
+                gradient_as_bucket_view=True, static_graph=True)
         else:
             model.cuda()
             # DistributedDataParallel will divide and allocate batch_size to all
             # available GPUs if device_ids are not set
-            model = torch.nn.parallel.DistributedDataParallel(model)
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, bucket_cap_mb=25, gradient_as_bucket_view=True,
+                static_graph=True)
     elif args.gpu is not None:
         torch.cuda.set_device(args.gpu)
         model = model.cuda(args.gpu)
     else:
-        # DataParallel will divide and allocate batch_size to all available GPUs
-        if args.arch.startswith('alexnet') or args.arch.startswith('vgg'):
-            model.features = torch.nn.DataParallel(model.features)
-            model.cuda()
-        else:
-            model = torch.nn.DataParallel(model).cuda()
+        # only one GPU visible, multi-GPU nodes go through DistributedDataParallel
+        model = model.cuda()
 
+    # resolved once so the per-batch code does not re-check args.gpu / CUDA
+    if not torch.cuda.is_available():
+        args.device = torch.device('cpu')
+    elif args.gpu is not None:
+        args.device = torch.device('cuda:{}'.format(args.gpu))
+    else:
+        args.device = torch.device('cuda')
+
+    # second copy of the network for save_stats; its buffers are refreshed
+    # from the training model with load_state_dict instead of a deepcopy
+    stats_model = None
+    if args.save_noise and is_log_process(args):
+        stats_model = build_model(args).to(args.device, memory_format=torch.channels_last)
 
-            
 #     weight_names, weights = param_weights(model)
 
-    with open(log_train_file, 'w') as log_tf, open(log_valid_file, 'w') as log_vf, open(log_sharp_file, 'w') as log_sf, open(log_noise_file, 'w') as log_nf:
-        log_tf.write('epoch,loss,accu1\n')
-        log_nf.write('epoch,sto_grad_norm,stograd_linf,noisenorm,gradnorm,l1norm,linfnorm, update_size, change_in_grad_sq, momentum_size\n')
-#         log_sf.write('epoch,sharpness,' +','.join(weight_names) + '\n')
-        log_vf.write('epoch,valloss,valaccu\n')
-        log_sf.write('epoch,sharpness, dir_sharpness' + '\n')
+    if is_log_process(args):
+        with open(log_train_file, 'w') as log_tf, open(log_valid_file, 'w') as log_vf, open(log_sharp_file, 'w') as log_sf, open(log_noise_file, 'w') as log_nf:
+            log_tf.write('epoch,loss,accu1\n')
+            log_nf.write('epoch,sto_grad_norm,stograd_linf,noisenorm,gradnorm,l1norm,linfnorm, update_size, change_in_grad_sq, momentum_size\n')
+#             log_sf.write('epoch,sharpness,' +','.join(weight_names) + '\n')
+            log_vf.write('epoch,valloss,valaccu\n')
+            log_sf.write('epoch,sharpness, dir_sharpness' + '\n')
 
             
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda(args.gpu)
+    # the fused kernel needs CUDA parameters; foreach is the multi-tensor fallback
+    # (the two cannot be enabled together)
+    use_fused = torch.cuda.is_available()
     optimizer = torch.optim.SGD(model.parameters(), args.lr,
                                 momentum=args.momentum,
-                                weight_decay=args.weight_decay)
-    
+                                weight_decay=args.weight_decay,
+                                nesterov=False,
+                                foreach=not use_fused,
+                                fused=use_fused)
+    # mixed precision for the training/validation forward passes
+    scaler = torch.cuda.amp.GradScaler(enabled=torch.cuda.is_available())
     
     if args.lr_schedule == "cosine":
         print('using cosine with total step %d' % args.epochs * len(train_loader))
@@ -337,13 +403,18 @@ def main_worker(gpu, ngpus_per_node, args):
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
+    # the compiled wrapper shares its parameters with model, whose state_dict
+    # keys are left unchanged for checkpoints and load_model
+    train_model = model
+    if args.compile:
+        train_model = torch.compile(model, mode='max-autotune', fullgraph=False, dynamic=False)
+
     cudnn.benchmark = True
 
     # Data loading code
     traindir = os.path.join(args.data, 'train')
     valdir = os.path.join(args.data, 'val')
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                     std=[0.229, 0.224, 0.225])
+    # normalization is applied to whole batches on the GPU by CUDAPrefetcher
 
     train_dataset = datasets.ImageFolder(
         traindir,
@@ -351,7 +422,6 @@ def main_worker(gpu, ngpus_per_node, args):
             transforms.RandomResizedCrop(224),
             transforms.RandomHorizontalFlip(),
             transforms.ToTensor(),
-            normalize,
         ]))
 
     if args.distributed:
@@ -359,13 +429,25 @@ def main_worker(gpu, ngpus_per_node, args):
     else:
         train_sampler = None
 
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None), prefetch_factor=4,
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler, persistent_workers=True)
+    if args.dali:
+        # batches come out of DALI already on the GPU and normalized
+        train_loader = DALILoader(
+            traindir, args.batch_size, args.workers,
+            args.gpu if args.gpu is not None else torch.cuda.current_device(),
+            shard_id=args.rank if args.distributed else 0,
+            num_shards=args.world_size if args.distributed else 1,
+            seed=args.seed if args.seed is not None else -1)
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None), prefetch_factor=4,
+            num_workers=args.workers, pin_memory=True, sampler=train_sampler, persistent_workers=True)
 
-    stats_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None), prefetch_factor=4,
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler, persistent_workers=True)
+    # only save_stats and the noise stats in train() read from stats_loader
+    stats_loader = None
+    if args.save_noise and is_log_process(args):
+        stats_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=args.stats_batch_size, shuffle=(train_sampler is None), prefetch_factor=4,
+            num_workers=args.workers, pin_memory=True, sampler=train_sampler, persistent_workers=True)
 
     
     val_loader = torch.utils.data.DataLoader(
@@ -373,7 +455,6 @@ def main_worker(gpu, ngpus_per_node, args):
             transforms.Resize(256),
             transforms.CenterCrop(224),
             transforms.ToTensor(),
-            normalize,
         ])),
         batch_size=args.batch_size, shuffle=False,
         num_workers=args.workers, pin_memory=True)
@@ -399,30 +480,30 @@ def main_worker(gpu, ngpus_per_node, args):
             scheduler.step()
 
         # train for one epoch
-        train(train_loader, stats_loader, model, criterion, optimizer, epoch, args, pretrained=pretrained)
+        train(train_loader, stats_loader, train_model, stats_model, criterion, optimizer, scaler, epoch, args, pretrained=pretrained)
 
         
         # evaluate on validation set
         if epoch % args.eval_freq == 0:
-            acc1 = validate(epoch, val_loader, model, criterion, args)
+            acc1 = validate(epoch, val_loader, train_model, criterion, args)
 
         # if (not args.multiprocessing_distributed or (args.multiprocessing_distributed
         #         and args.rank % ngpus_per_node == 0)) and (epoch % args.epoch_interval == 0):
         #     save_stats(stats_loader, copy.deepcopy(model), criterion, optimizer, epoch, args)
 
+    wait_for_checkpoint()
+
             
             
 def compute_grad_epoch(dataloader, model, criterion, optimizer, epoch, args):
     model.train()
-    model.zero_grad()
+    model.zero_grad(set_to_none=True)
     
     for i in range(args.noise_size):
         images, target = next(dataloader)        # measure data loading time
 
-        if args.gpu is not None:
-            images = images.cuda(args.gpu, non_blocking=True)
-        if torch.cuda.is_available():
-            target = target.cuda(args.gpu, non_blocking=True)
+        images = images.to(args.device, non_blocking=True)
+        target = target.to(args.device, non_blocking=True)
 
         # compute output
         
@@ -440,7 +521,7 @@ def compute_grad_epoch(dataloader, model, criterion, optimizer, epoch, args):
             
     true_grad = {}
     clone_grad(model, true_grad)
-    model.zero_grad()
+    model.zero_grad(set_to_none=True)
     return true_grad        
 
 
@@ -459,21 +540,18 @@ def compute_sto_grad_norm(dataloader, model, criterion, optimizer, epoch, args,
 
 
     grad_change_sq, _, _ = compute_noise(true_grads, prev_true_grad)
-    gradnorm_sq = compute_norm(true_grads) 
-    true_gradnorml1 = compute_l1norm(true_grads) 
-    true_gradnormlinf = compute_linfnorm(true_grads) 
+    gradnorm_sq, true_gradnorml1, true_gradnormlinf = compute_all_norms(true_grads)
 
+    sto_grads = {}
     for i in range(args.noise_size):
         images, target = next(dataloader)
         # measure data loading time
 
-        if args.gpu is not None:
-            images = images.cuda(args.gpu, non_blocking=True)
-        if torch.cuda.is_available():
-            target = target.cuda(args.gpu, non_blocking=True)
+        images = images.to(args.device, non_blocking=True)
+        target = target.to(args.device, non_blocking=True)
 
         # compute output
-        model.zero_grad()
+        model.zero_grad(set_to_none=True)
         output = model(images)
         loss = criterion(output, target) 
 
@@ -482,7 +560,6 @@ def compute_sto_grad_norm(dataloader, model, criterion, optimizer, epoch, args,
         # compute gradient and do SGD step
         loss.backward()
 
-        sto_grads = {}
         clone_grad(model, sto_grads)
         instance_noisesq, instance_gradsq, instance_gradlinf = compute_noise(sto_grads, true_grads)
         noise_sq.append(instance_noisesq)
@@ -492,7 +569,7 @@ def compute_sto_grad_norm(dataloader, model, criterion, optimizer, epoch, args,
         if i == args.noise_size - 1:
             break
 
-    model.zero_grad()
+    model.zero_grad(set_to_none=True)
     return noise_sq, stograd_sq, stograd_linf, gradnorm_sq, true_gradnorml1, true_gradnormlinf, grad_change_sq    
 
 
@@ -500,16 +577,14 @@ def save_stats(stats_loader, model, criterion, optimizer, epoch, args, prev_true
     # switch to train mode
     print("Called save_stats")
     model.train()
-    stats_iterator = iter(stats_loader)
+    # one pass over stats_loader shared by all the statistics below; restarting it
+    # would refill the worker prefetch queues each time
+    stats_iterator = CUDAPrefetcher(stats_loader, args.device)
 
     if args.save_sharpness:
         print("Saving sharpness")
-        model.zero_grad()
-        dir_sharpness = dir_hessian(model, stats_iterator, criterion, args.sharpness_batches)
-        stats_iterator = iter(stats_loader)
-        model.zero_grad()
-        sharpness = eigen_hessian(model, stats_iterator, criterion, args.sharpness_batches)
-        stats_iterator = iter(stats_loader)
+        model.zero_grad(set_to_none=True)
+        sharpness, dir_sharpness = lanczos_hessian(model, stats_iterator, criterion, args.sharpness_batches)
 
 #         weight_names, weights = param_weights(model)
 #         weights_str = ['%4.4f' % w for w in weights]
@@ -517,7 +592,7 @@ def save_stats(stats_loader, model, criterion, optimizer, epoch, args, prev_true
 
     if args.save_noise:
         print("Saving noise level")
-        model.zero_grad()
+        model.zero_grad(set_to_none=True)
         # true_gradnorm, sto_grad_norm, sto_noise_norm, true_gradnorml1, true_gradnormlinf = 0,0,0, 0, 0
         noise_sq, stograd_sq, stograd_linf, gradnorm_sq, true_gradnorml1, true_gradnormlinf, grad_change_sq = compute_sto_grad_norm(stats_iterator, model, criterion, 
                                                                                                             optimizer, epoch, args, prev_true_grad)
@@ -538,9 +613,13 @@ def save_stats(stats_loader, model, criterion, optimizer, epoch, args, prev_true
                 gradnorm=gradnorm_sq, sto_grad_norm=sto_grad_norm, stograd_linf=stograd_linf,
                 noisenorm=sto_noise_norm, l1norm=true_gradnorml1, linfnorm=true_gradnormlinf, 
                 update_size=update_size, grad_change_sq=grad_change_sq, m_size=m_size))
-            
 
-def train(train_loader, stats_loader, model, criterion, optimizer, epoch, args, pretrained=False):
+    if torch.cuda.is_available() and \
+            torch.cuda.memory_reserved() - torch.cuda.memory_allocated() > EMPTY_CACHE_THRESHOLD:
+        torch.cuda.empty_cache()
+
+
+def train(train_loader, stats_loader, model, stats_model, criterion, optimizer, scaler, epoch, args, pretrained=False):
     losses = AverageMeter('Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
     batch_time = AverageMeter('Time', ':6.3f')
@@ -551,46 +630,59 @@ def train(train_loader, stats_loader, model, criterion, optimizer, epoch, args,
         [batch_time, data_time, losses, top1, top5],
         prefix="Epoch: [{}]".format(epoch))
 
+    # the stats are gathered by the logging process of each node only
+    save_noise = args.save_noise and is_log_process(args)
+
     # switch to train mode
     model.train()
     end = time.time()
-    for i, (images, target) in enumerate(train_loader):
+    prefetcher = CUDAPrefetcher(train_loader, args.device, normalize=not args.dali)
+    images, target = prefetcher.next()
+    i = 0
+    while images is not None:
         
         
         # measure data loading time
         data_time.update(time.time() - end)
 
-        if args.gpu is not None:
-            images = images.cuda(args.gpu, non_blocking=True)
-        if torch.cuda.is_available():
-            target = target.cuda(args.gpu, non_blocking=True)
+        prev_true_grad, update_size, m_size = None, 0, 0
+        if not pretrained and save_noise and i % args.stat_freq == 0:
+
+            print("saving stat info before backward")
+            # on the bare module and ahead of the training forward, since only this process
+            # runs it and neither DistributedDataParallel nor torch.compile may see the extra passes
+            prev_true_grad = compute_grad_epoch(CUDAPrefetcher(stats_loader, args.device), unwrap_model(model), criterion, optimizer, epoch, args)
 
         # compute output
-        output = model(images)
-        loss = criterion(output, target)
+        with torch.cuda.amp.autocast(enabled=scaler.is_enabled(), dtype=torch.float16):
+            output = model(images)
+            loss = criterion(output, target)
 
         # measure accuracy and record loss
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), images.size(0))
+        losses.update(loss.detach(), images.size(0))
         top1.update(acc1[0], images.size(0))
         top5.update(acc5[0], images.size(0))
 
         # compute gradient and do SGD step
-        optimizer.zero_grad()
-        prev_true_grad, update_size, m_size = None, 0, 0
+        optimizer.zero_grad(set_to_none=True)
 
         if not pretrained:
-            if args.save_noise and i % args.stat_freq == 0:
-
-                print("saving stat info before backward")
-                prev_true_grad = compute_grad_epoch(iter(stats_loader), model, criterion, optimizer, epoch, args)
-
-
-            loss.backward()
-
-            optimizer.step()
-
-            if args.save_noise and i % args.stat_freq == 0:
+            scaler.scale(loss).backward()
+
+            # GradScaler.step unscales the grads in place, so the stats below
+            # still see the true update direction
+            stat_step = save_noise and i % args.stat_freq == 0
+            # get_scale() syncs with the GPU, so it is only read at stat points
+            scale = scaler.get_scale() if stat_step else None
+            scaler.step(optimizer)
+            scaler.update()
+
+            # the scale only drops when inf/nan grads made GradScaler skip the step
+            if stat_step and scaler.get_scale() < scale:
+                print("optimizer step skipped on overflow, writing nan update stats")
+                update_size, m_size = float('nan'), float('nan')
+            elif stat_step:
 
                 print("saving stat info before update")
                 update_direction = {}
@@ -612,16 +704,18 @@ def train(train_loader, stats_loader, model, criterion, optimizer, epoch, args,
 
         if i % args.print_freq == 0:
             progress.display(i)
-        if args.save_noise and (pretrained or i % args.stat_freq == 0):
-            save_stats(stats_loader, copy.deepcopy(model), criterion, optimizer, epoch, args, prev_true_grad, update_size, m_size)
+        if save_noise and (pretrained or i % args.stat_freq == 0):
+            stats_model.load_state_dict(unwrap_model(model).state_dict(), strict=True)
+            save_stats(stats_loader, stats_model, criterion, optimizer, epoch, args, prev_true_grad, update_size, m_size)
 
         if pretrained:
             break
 
+        images, target = prefetcher.next()
+        i += 1
 
     
-    if not args.multiprocessing_distributed or (args.multiprocessing_distributed
-                                                and args.rank % ngpus_per_node == 0):
+    if is_log_process(args):
         with open(log_train_file, 'a') as log_vf:
             log_vf.write('{epoch},{loss: 8.5f},{accu: 8.5f}\n'.format(epoch=epoch, loss=losses.avg, accu=top1.avg))     
 
@@ -642,19 +736,18 @@ def validate(epoch, val_loader, model, criterion, args):
 
     with torch.no_grad():
         end = time.time()
-        for i, (images, target) in enumerate(val_loader):
-            if args.gpu is not None:
-                images = images.cuda(args.gpu, non_blocking=True)
-            if torch.cuda.is_available():
-                target = target.cuda(args.gpu, non_blocking=True)
-
+        prefetcher = CUDAPrefetcher(val_loader, args.device)
+        images, target = prefetcher.next()
+        i = 0
+        while images is not None:
             # compute output
-            output = model(images)
-            loss = criterion(output, target)
+            with torch.cuda.amp.autocast(enabled=torch.cuda.is_available(), dtype=torch.float16):
+                output = model(images)
+                loss = criterion(output, target)
 
             # measure accuracy and record loss
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
-            losses.update(loss.item(), images.size(0))
+            losses.update(loss.detach(), images.size(0))
             top1.update(acc1[0], images.size(0))
             top5.update(acc5[0], images.size(0))
 
@@ -665,26 +758,68 @@ def validate(epoch, val_loader, model, criterion, args):
             if i % args.print_freq == 0:
                 progress.display(i)
 
+            images, target = prefetcher.next()
+            i += 1
 
         print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
               .format(top1=top1, top5=top5))
         
-    if not args.multiprocessing_distributed or (args.multiprocessing_distributed
-                                                and args.rank % ngpus_per_node == 0):
+    if is_log_process(args):
         with open(log_valid_file, 'a') as log_vf:
             log_vf.write('{epoch},{loss: 8.5f},{accu: 8.5f}\n'.format(epoch=epoch, loss=losses.avg, accu=top1.avg))     
 
     return top1.avg
 
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
+# checkpoints are written by a background thread from pinned CPU copies; the
+# thread is only started by the first save_checkpoint call of a process
+_ckpt_executor = None
+_ckpt_future = None
+_ckpt_buffer = {}
+
+
+def _copy_to_cpu(obj, buf, key=''):
+    """Copies every tensor in a (nested) state into a reusable pinned CPU buffer"""
+    if isinstance(obj, torch.Tensor):
+        pinned = buf.get(key)
+        if pinned is None or pinned.shape != obj.shape or pinned.dtype != obj.dtype:
+            pinned = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=torch.cuda.is_available())
+            buf[key] = pinned
+        pinned.copy_(obj.detach(), non_blocking=True)
+        return pinned
+    if isinstance(obj, dict):
+        return {k: _copy_to_cpu(v, buf, '{}/{}'.format(key, k)) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(v, buf, '{}/{}'.format(key, i)) for i, v in enumerate(obj))
+    return obj
+
+
+def _write_checkpoint(state, is_best, filename):
     torch.save(state, filename)
     if is_best:
-        shutil.copyfile(filename, 'model_best.pth.tar')
+        shutil.copyfile(filename, os.path.join(os.path.dirname(filename), 'model_best.pth.tar'))
+
+
+def wait_for_checkpoint():
+    if _ckpt_future is not None:
+        _ckpt_future.result()
+
+
+def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
+    global _ckpt_executor, _ckpt_future
+    if _ckpt_executor is None:
+        _ckpt_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    # the pinned buffers are reused, so the previous write has to finish first
+    wait_for_checkpoint()
+    cpu_state = _copy_to_cpu(state, _ckpt_buffer)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    _ckpt_future = _ckpt_executor.submit(_write_checkpoint, cpu_state, is_best, filename)
 
 
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value. Tensor values are summed on
+    their device and only copied to the host when the meter is read"""
     def __init__(self, name, fmt=':f'):
         self.name = name
         self.fmt = fmt
@@ -692,7 +827,6 @@ class AverageMeter(object):
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -700,11 +834,72 @@ class AverageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        if self.count == 0:
+            return 0
+        return float(self.sum) / self.count
 
     def __str__(self):
         fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
-        return fmtstr.format(**self.__dict__)
+        return fmtstr.format(name=self.name, val=float(self.val), avg=self.avg)
+
+
+class CUDAPrefetcher(object):
+    """Copies the next batch to the GPU on a side stream while the current one is used,
+    converting it to channels_last and normalizing it there"""
+    def __init__(self, loader, device, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+                 normalize=True):
+        self.loader = iter(loader)
+        self.device = device
+        self.do_normalize = normalize
+        self.mean = torch.tensor(mean, device=device).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, device=device).view(1, 3, 1, 1)
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.preload()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        images, target = self.next()
+        if images is None:
+            raise StopIteration
+        return images, target
+
+    def preload(self):
+        try:
+            self.next_images, self.next_target = next(self.loader)
+        except StopIteration:
+            self.next_images, self.next_target = None, None
+            return
+
+        if self.stream is None:
+            self.next_images = self.normalize(self.next_images)
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_images = self.next_images.to(self.device, non_blocking=True)
+            self.next_target = self.next_target.to(self.device, non_blocking=True)
+            self.next_images = self.normalize(self.next_images)
+
+    def normalize(self, images):
+        if not self.do_normalize:
+            return images
+        images = images.to(memory_format=torch.channels_last)
+        return images.sub_(self.mean).div_(self.std)
+
+    def next(self):
+        """Returns the prefetched batch, or (None, None) once the loader is exhausted"""
+        images, target = self.next_images, self.next_target
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            if images is not None:
+                # the tensors were allocated on the side stream
+                images.record_stream(torch.cuda.current_stream())
+                target.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return images, target
 
 
 class ProgressMeter(object):
@@ -737,13 +932,13 @@ def accuracy(output, target, topk=(1,)):
         maxk = max(topk)
         batch_size = target.size(0)
 
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
+        _, pred = output.topk(maxk, dim=1)
+        # [batch_size, maxk], compared in place without transposing
+        correct = pred.eq(target.unsqueeze(1))
 
         res = []
         for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
+            correct_k = correct[:, :k].any(dim=1).sum(0, keepdim=True, dtype=torch.float32)
             res.append(correct_k.mul_(100.0 / batch_size))
         return res
 
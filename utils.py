@@ -2,48 +2,57 @@ import time
 import torch
 import torch.autograd as autograd
 import functools
+import itertools
 import os, shutil
 import numpy as np
 
 
 def compute_noise(stoc_grads, true_grads):
-    total_noise_sq = 0 
-    total_grad_sq = 0
-    total_grad_inf = 0
-    for k in stoc_grads.keys():
-        total_noise_sq += (stoc_grads[k]- true_grads[k]).norm(2).item() ** 2
-        total_grad_sq += stoc_grads[k].norm(2).item() ** 2
-        total_grad_inf = max(total_grad_inf, torch.max(torch.abs(stoc_grads[k])).item())
+    if not stoc_grads:
+        return 0, 0, 0
+    keys = list(stoc_grads.keys())
+    stoc = [stoc_grads[k] for k in keys]
+    diff = torch._foreach_sub(stoc, [true_grads[k] for k in keys])
+    noise = torch.stack(torch._foreach_norm(diff, 2))
+    grad = torch.stack(torch._foreach_norm(stoc, 2))
+    grad_inf = torch.stack(torch._foreach_norm(stoc, float('inf')))
+    total_noise_sq, total_grad_sq, total_grad_inf = torch.stack(
+        [noise.pow(2).sum(), grad.pow(2).sum(), grad_inf.max()]).tolist()
     return total_noise_sq, total_grad_sq, total_grad_inf
 
 
 def compute_norm(grads):
+    if not grads:
+        return 0
+    norms = torch._foreach_norm(list(grads.values()), 2)
+    return torch.linalg.vector_norm(torch.stack(norms)).item() ** 2
 
-    total_grad_sq = 0
-    for k in grads.keys():
-        total_grad_sq += grads[k].norm(2).item() ** 2
-    return total_grad_sq
-
-
-def compute_l1norm(grads):
-    total_grad_l1 = 0
-    for k in grads.keys():
-        total_grad_l1 += grads[k].norm(1).item()
-    return total_grad_l1
 
-
-def compute_linfnorm(grads):
-    total_grad_inf = 0
-    for k in grads.keys():
-        total_grad_inf = max(total_grad_inf, torch.max(torch.abs(grads[k])).item())
-    return total_grad_inf
+def compute_all_norms(grads):
+    """Squared l2, l1 and linf norms of the gradient dict, reading it with one multi-tensor pass per norm"""
+    if not grads:
+        return 0, 0, 0
+    tensors = list(grads.values())
+    l2 = torch.stack(torch._foreach_norm(tensors, 2))
+    l1 = torch.stack(torch._foreach_norm(tensors, 1))
+    linf = torch.stack(torch._foreach_norm(tensors, float('inf')))
+    l2sq, l1, linf = torch.stack([l2.pow(2).sum(), l1.sum(), linf.max()]).tolist()
+    return l2sq, l1, linf
 
 
 def clone_grad(net, true_grads):
+    names, grads = [], []
     for name, param in net.named_parameters():
         if param.grad is None:
             continue
-        true_grads[name] = torch.clone(param.grad.data).detach()
+        names.append(name)
+        grads.append(param.grad.detach())
+    if names and all(name in true_grads for name in names):
+        # reuse the buffers from a previous call
+        torch._foreach_copy_([true_grads[name] for name in names], grads)
+    else:
+        for name, grad in zip(names, grads):
+            true_grads[name] = torch.clone(grad)
         
 def param_weights(net):
     weight_names = []
@@ -101,6 +110,46 @@ def save_checkpoint(model, optimizer, path, epoch):
 
 
 
+class DALILoader(object):
+    """
+    ImageNet training loader that decodes, crops, flips and normalizes on the GPU
+    with NVIDIA DALI. Yields (images, target) like a DataLoader; images are
+    NCHW views over channels_last memory.
+    """
+    def __init__(self, data_dir, batch_size, num_threads, device_id,
+                 shard_id=0, num_shards=1, crop=224, seed=-1):
+        from nvidia.dali import pipeline_def, fn, types
+        from nvidia.dali.plugin.pytorch import DALIClassificationIterator, LastBatchPolicy
+
+        @pipeline_def
+        def train_pipeline():
+            jpegs, labels = fn.readers.file(file_root=data_dir, shard_id=shard_id,
+                                            num_shards=num_shards, random_shuffle=True,
+                                            name='Reader')
+            images = fn.decoders.image(jpegs, device='mixed', output_type=types.RGB)
+            images = fn.random_resized_crop(images, device='gpu', size=[crop, crop])
+            images = fn.crop_mirror_normalize(images, dtype=types.FLOAT, output_layout='HWC',
+                                              mean=[0.485 * 255, 0.456 * 255, 0.406 * 255],
+                                              std=[0.229 * 255, 0.224 * 255, 0.225 * 255],
+                                              mirror=fn.random.coin_flip(probability=0.5))
+            return images, labels.gpu()
+
+        pipe = train_pipeline(batch_size=batch_size, num_threads=max(num_threads, 1),
+                              device_id=device_id, seed=seed)
+        pipe.build()
+        self.iterator = DALIClassificationIterator(pipe, reader_name='Reader', auto_reset=True,
+                                                   last_batch_policy=LastBatchPolicy.PARTIAL)
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        for batch in self.iterator:
+            images = batch[0]['data'].permute(0, 3, 1, 2)
+            target = batch[0]['label'].view(-1).long()
+            yield images, target
+
+
 def eigen_variance(net, criterion, dataloader, n_iters=5, tol=1e-2, verbose=False):
     n_parameters = num_parameters(net)
     v0 = torch.randn(n_parameters)
@@ -109,46 +158,94 @@ def eigen_variance(net, criterion, dataloader, n_iters=5, tol=1e-2, verbose=Fals
     return mu
 
 
-def eigen_hessian(net, dataloader, criterion, batches, n_iters=5, tol=1e-2, verbose=False):
-    # n_parameters = num_parameters(net)
-    # v0 = torch.randn(n_parameters).cuda()
-
-    # Initialize with grad direction 
-    for i in range(batches):
-        bx, by = next(dataloader)
-        output = net(bx.cuda())
-        loss = criterion(output, by.cuda()) / batches
+def lanczos_hessian(net, dataloader, criterion, batches, n_iters=5, tol=1e-2, cache_bytes=2 << 30):
+    """
+    Sharpness, the dominant Hessian eigenvalue from Lanczos iterations started at
+    the gradient, and dir_sharpness, the dir_hessian estimate averaged over pairs
+    of batches. Both read the same `batches` batches: when they fit in
+    cache_bytes (2GB) they are drawn once and kept on the device, otherwise
+    every pass streams fresh batches from dataloader. A 224px ImageNet batch of
+    250 images takes about 150MB, so -sharpness_batches 600 -b 250 would need
+    about 90GB and streams.
+    """
+    first = next(dataloader)
+    batch_bytes = sum(t.numel() * t.element_size() for t in first)
+    if batch_bytes * batches <= cache_bytes:
+        cached = [first] + [next(dataloader) for _ in range(batches - 1)]
+    else:
+        cached = None
+        dataloader = itertools.chain([first], dataloader)
+
+    def draw():
+        if cached is not None:
+            return cached
+        return (next(dataloader) for _ in range(batches))
+
+    # Initialize with grad direction
+    net.zero_grad()
+    for bx, by in draw():
+        loss = criterion(net(bx), by) / batches
         loss.backward()
+    g = torch.cat([p.grad.reshape(-1) for p in net.parameters()])
 
-    v0 = [p.grad.view(-1) for p in net.parameters()]
-    v0 = torch.cat(v0)
-
-    Av_func = lambda v: hessian_vec_prod(net, dataloader, criterion, batches, v)
-    mu = power_method(v0, Av_func, n_iters, tol, verbose)
-    return mu
+    def Av_func(v):
+        Hv = 0
+        for bx, by in draw():
+            Hv += Hv_batch(net, criterion, bx, by, v)
+        return Hv / batches
 
-def dir_hessian(net, dataloader, criterion, batches):
-    sharpness = 0    
-    n_batchs = batches #len(dataloader)
+    sharpness = lanczos(g, Av_func, n_iters, tol)
 
+    # curvature on one batch along the normalized gradient of the next one
+    dir_sharpness = 0
     for i in range(batches):
-        bx, by = next(dataloader)
-        output = net(bx.cuda())
-        loss = criterion(output, by.cuda()) 
-        loss.backward()
-
-        v0 = [p.grad.view(-1) for p in net.parameters()]
-        v0 = torch.cat(v0)
-        v0 = v0/v0.norm()
-
-        # print("dir_hessian iter %d" % i)
-        bx, by = next(dataloader)
+        if cached is not None:
+            (gx, gy), (bx, by) = cached[i], cached[(i + 1) % batches]
+        else:
+            (gx, gy), (bx, by) = next(dataloader), next(dataloader)
         net.zero_grad()
-        sharpness += dir_sharpness_batch(net, criterion, bx.cuda(), by.cuda(), v0)
+        criterion(net(gx), gy).backward()
+        v0 = torch.cat([p.grad.reshape(-1) for p in net.parameters()])
+        dir_sharpness += dir_sharpness_batch(net, criterion, bx, by, v0 / v0.norm())
+    net.zero_grad()
 
-    return sharpness/n_batchs
+    return sharpness, dir_sharpness / batches
 
 
+def lanczos(v0, Av_func, n_iters=5, tol=1e-2):
+    """
+    Lanczos iterations from v0. Returns the Ritz value of largest magnitude,
+    the estimate power_method gives after as many products, and stops like
+    power_method once its relative change drops below tol.
+    """
+    q = v0 / v0.norm()
+    q_prev = torch.zeros_like(q)
+    alphas, betas = [], []
+    beta = 0
+    mu = 1e-6
+    for i in range(n_iters):
+        w = Av_func(q)
+        alpha = torch.dot(w, q).item()
+        alphas.append(alpha)
+
+        T = torch.diag(torch.tensor(alphas, dtype=torch.float64))
+        if betas:
+            off = torch.tensor(betas, dtype=torch.float64)
+            T += torch.diag(off, 1) + torch.diag(off, -1)
+        eigs = torch.linalg.eigvalsh(T)
+        mu_pre = mu
+        mu = eigs[eigs.abs().argmax()].item()
+        if abs(mu-mu_pre)/abs(mu) < tol:
+            break
+
+        w = w - alpha * q - beta * q_prev
+        beta = w.norm().item()
+        # q spans an invariant subspace, the Ritz values are exact
+        if beta < 1e-8:
+            break
+        betas.append(beta)
+        q_prev, q = q, w / beta
+    return mu
 
 
 def variance_vec_prod(net, criterion, dataloader, v):
@@ -196,12 +293,12 @@ def Hv_batch(net, criterion, batch_x, batch_y, v):
     for grad_i in grads:
         ng = torch.numel(grad_i)
         v_i = v[idx:idx+ng]
-        res += torch.dot(v_i, grad_i.view(-1))
+        res += torch.dot(v_i, grad_i.reshape(-1))
         idx += ng
 
     Hv = autograd.grad(res, net.parameters())
     net.zero_grad()
-    Hv = [t.view(-1) for t in Hv]
+    Hv = [t.reshape(-1) for t in Hv]
     Hv = torch.cat(Hv)
     return Hv
 
@@ -221,13 +318,13 @@ def dir_sharpness_batch(net, criterion, batch_x, batch_y, v):
     for grad_i in grads:
         ng = torch.numel(grad_i)
         v_i = v[idx:idx+ng]
-        res += torch.dot(v_i, grad_i.view(-1))
+        res += torch.dot(v_i, grad_i.reshape(-1))
         idx += ng
 
     Hv = autograd.grad(res, net.parameters())
-    Hv = [t.view(-1) for t in Hv]
+    Hv = [t.reshape(-1) for t in Hv]
     Hv = torch.cat(Hv)
-    stograds = [t.view(-1) for t in grads]
+    stograds = [t.reshape(-1) for t in grads]
     stograds = torch.cat(stograds)
     sharpness = Hv.norm()/stograds.norm()
     return sharpness.item()